@@ -0,0 +1,44 @@
+# Production server:  gunicorn main:app
+# (picks this file up automatically from the working directory)
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# uvloop + httptools are used automatically because uvicorn[standard]
+# installs them.
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Without REDIS_URL, jobs live in one process's in-memory JOBS, so polling
+# GET /renderings/{id} only works with a single worker. With Redis, every
+# worker sees every job and we run one worker process per core.
+if os.getenv("REDIS_URL"):
+    workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+else:
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Import main.py once in the master so the color tables, compiled tint
+# kernel and lookup tables are shared copy-on-write by all workers.
+preload_app = True
+
+
+def nworkers_changed(server, new_value, old_value):
+    """
+    Runs with the effective worker count (after -w / --workers overrides
+    the value above) – and, unlike on_starting, before the app is preloaded,
+    so RENDER_WORKERS is still read by main.py after we set it.
+    """
+    if old_value is not None:
+        # TTIN / TTOU at runtime; the pools are already sized
+        if new_value > 1 and not os.getenv("REDIS_URL"):
+            server.log.error("More than 1 worker without REDIS_URL: job polling will 404")
+        return
+    if new_value > 1 and not os.getenv("REDIS_URL"):
+        raise SystemExit(f"{new_value} workers require REDIS_URL (jobs are per-process otherwise)")
+    # Every worker has its own render pool; with a process per core, one
+    # render thread each is enough unless RENDER_WORKERS says otherwise.
+    if new_value > 1:
+        os.environ.setdefault("RENDER_WORKERS", "1")
@@ -1,12 +1,23 @@
+import asyncio
+import glob
+import json
 import os
 import uuid
-from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import List, Literal, Optional
 from fastapi.middleware.cors import CORSMiddleware
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Depends, Request
+from fastapi.responses import FileResponse, Response
 from pydantic import BaseModel
 from PIL import Image
+import numpy as np
+from numba import njit
+import aiofiles
+from redis import asyncio as aioredis
 
 # Load config from environment / .env
 from dotenv import load_dotenv
@@ -14,6 +25,21 @@ load_dotenv()
 
 API_KEYS = {k.strip() for k in os.getenv("API_KEYS", "test-key-123").split(",") if k.strip()}
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
+# How many decoded source images to keep in memory for re-renders
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "64"))
+# Longest edge (px) an input is scaled down to before tinting
+MAX_EDGE = int(os.getenv("MAX_EDGE", "1600"))
+# Encoder settings for rendered previews (speed over size)
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "82"))
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
+# Threads doing CPU-bound render work (decode / blend / encode)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+# Most recent jobs kept by the in-memory job store
+JOBS_MAX = int(os.getenv("JOBS_MAX", "10000"))
+# When set, renders are queued in Redis and done by worker.py instead of in-process
+REDIS_URL = os.getenv("REDIS_URL")
+# Seconds a job stays in Redis after it was queued / last updated
+JOB_TTL = int(os.getenv("JOB_TTL", str(7 * 24 * 3600)))
 
 BASE_DIR = "data"
 IMAGES_DIR = os.path.join(BASE_DIR, "images")
@@ -58,41 +84,46 @@ SW_COLOR_TABLE = [
     {"id": "sw-6211", "code": "SW 6211", "name": "Rainwashed",      "hex": "#C2D4CC", "family": "blue-green"},
 ]
 
-# Lookup dictionaries
-SW_BY_ID = {c["id"].lower(): c for c in SW_COLOR_TABLE}
-SW_BY_CODE = {c["code"].lower(): c for c in SW_COLOR_TABLE}
-SW_BY_NAME = {c["name"].strip().lower(): c for c in SW_COLOR_TABLE}
+def hex_to_rgb(hex_str: str):
+    hex_str = hex_str.lstrip("#")
+    if len(hex_str) == 3:
+        hex_str = "".join(c * 2 for c in hex_str)
+    return tuple(int(hex_str[i:i+2], 16) for i in (0, 2, 4))
+
 
-def resolve_sw_color(color_key: str) -> str:
+def _build_sw_lookup() -> dict:
+    """Map every accepted spelling of a color to its RGB tuple."""
+    lookup = {}
+    for c in SW_COLOR_TABLE:
+        rgb = hex_to_rgb(c["hex"])
+        lookup[c["id"].lower()] = rgb                      # 'sw-7008'
+        lookup[c["code"].lower()] = rgb                    # 'sw 7008'
+        lookup[c["code"].lower().replace(" ", "-")] = rgb  # 'sw-7008'
+        lookup[c["name"].strip().lower()] = rgb            # 'alabaster'
+    return lookup
+
+
+# Lookup dictionary (built once at import, one hit per request)
+SW_ANY = _build_sw_lookup()
+
+# Fallback if unknown – neutral gray (#CCCCCC)
+SW_DEFAULT_RGB = (0xCC, 0xCC, 0xCC)
+
+def resolve_sw_rgb(color_key: str) -> tuple:
     """
     Accepts:
       - 'sw-7008'
       - 'SW 7008'
       - 'Alabaster'
     Returns:
-      - hex color string like '#EDE6D9'
+      - RGB tuple like (237, 230, 217)
     """
-    if not color_key:
-        return "#CCCCCC"
-
     ck = color_key.strip().lower()
-
-    # Try internal ID form, e.g. 'sw-7008'
-    if ck in SW_BY_ID:
-        return SW_BY_ID[ck]["hex"]
-
-    # Try code form, e.g. 'sw 7008' or 'SW 7008'
-    # Normalize spaces/dash
-    ck_normalized = ck.replace("-", " ")
-    if ck_normalized in SW_BY_CODE:
-        return SW_BY_CODE[ck_normalized]["hex"]
-
-    # Try name form, e.g. 'alabaster'
-    if ck in SW_BY_NAME:
-        return SW_BY_NAME[ck]["hex"]
-
-    # Fallback if unknown – neutral gray
-    return "#CCCCCC"
+    rgb = SW_ANY.get(ck)
+    if rgb is None:
+        # Dashes in place of spaces, e.g. 'accessible-beige'
+        rgb = SW_ANY.get(ck.replace("-", " "), SW_DEFAULT_RGB)
+    return rgb
 
 app = FastAPI(title="Color Rendering Demo API")
 
@@ -105,8 +136,9 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # Only what the API uses – keeps preflight responses constant
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
 # ---------- Auth dependency ----------
@@ -131,7 +163,20 @@ class RegionConfig(BaseModel):
 class RenderingRequest(BaseModel):
     image_id: str
     regions: List[RegionConfig]
-    output_format: str = "jpg"
+    output_format: Literal["jpg", "png"] = "jpg"
+
+
+class SWColor(BaseModel):
+    id: str
+    code: str
+    name: str
+    hex: str
+    family: str
+
+
+class ImageUpload(BaseModel):
+    id: str
+    file_url: str
 
 
 class RenderingJob(BaseModel):
@@ -141,20 +186,164 @@ class RenderingJob(BaseModel):
     config: RenderingRequest
 
 
-# In-memory store for demo
-JOBS = {}
+# In-memory store for demo (used when REDIS_URL is not set), least recently
+# used jobs are dropped beyond JOBS_MAX
+JOBS: "OrderedDict[str, RenderingJob]" = OrderedDict()
+
+
+def remember_job(job: RenderingJob):
+    JOBS[job.id] = job
+    JOBS.move_to_end(job.id)
+    if len(JOBS) > JOBS_MAX:
+        JOBS.popitem(last=False)
+
+# ---------- Redis job store / queue ----------
+
+RENDER_QUEUE = "renderings:queue"
+
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+
+def job_key(job_id: str) -> str:
+    return f"renderings:{job_id}"
+
+
+def _job_fields(job: RenderingJob) -> dict:
+    return {
+        "id": job.id,
+        "status": job.status,
+        "output_url": job.output_url or "",
+        "config": job.config.model_dump_json(),
+    }
+
+
+async def enqueue_job(job: RenderingJob, task: dict):
+    """Store the queued job (expires after JOB_TTL) and push its task for worker.py, atomically."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(job_key(job.id), mapping=_job_fields(job))
+        pipe.expire(job_key(job.id), JOB_TTL)
+        pipe.lpush(RENDER_QUEUE, json.dumps(task))
+        await pipe.execute()
+
+
+async def update_job(job_id: str, fields: dict) -> bool:
+    """
+    Update a queued job's hash and refresh its TTL. Does nothing (returns
+    False) if the job already expired – never recreates a partial hash.
+    """
+    key = job_key(job_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(key)
+            if not await pipe.exists(key):
+                return False
+            pipe.multi()
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, JOB_TTL)
+            await pipe.execute()
+        except aioredis.WatchError:
+            # Expired (or was otherwise touched) between the check and the write
+            return False
+    return True
+
+
+async def load_job(job_id: str) -> Optional[RenderingJob]:
+    data = await redis_client.hgetall(job_key(job_id))
+    # A hash without the queued fields is not a job we can return
+    if "id" not in data or "config" not in data:
+        return None
+    return RenderingJob(
+        id=data["id"],
+        status=data["status"],
+        output_url=data["output_url"] or None,
+        config=RenderingRequest.model_validate_json(data["config"]),
+    )
+
+
+# image_id -> file extension of the upload, so lookups don't scan IMAGES_DIR
+IMAGE_EXT: dict[str, str] = {}
+
+
+def _index_images():
+    """Pick up uploads already on disk (cold start only)."""
+    with os.scandir(IMAGES_DIR) as entries:
+        for entry in entries:
+            if entry.is_file():
+                image_id, ext = os.path.splitext(entry.name)
+                IMAGE_EXT[image_id] = ext
+
+
+def find_image_path(image_id: str) -> Optional[str]:
+    ext = IMAGE_EXT.get(image_id)
+    if ext is not None:
+        path = os.path.join(IMAGES_DIR, f"{image_id}{ext}")
+        return path if os.path.exists(path) else None
+
+    # Not seen by this process (e.g. uploaded through another worker).
+    # Uploads are always named by uuid4; anything else can't be one of ours
+    # (and must not be joined into a path).
+    try:
+        uuid.UUID(image_id)
+    except ValueError:
+        return None
+    # upload_image keeps the client's extension (.webp, .gif, ...), so match
+    # any; the hit is cached, so each id is only looked up once per process
+    matches = glob.glob(os.path.join(IMAGES_DIR, glob.escape(image_id) + ".*"))
+    if not matches:
+        return None
+    path = matches[0]
+    IMAGE_EXT[image_id] = os.path.splitext(path)[1]
+    return path
+
+
+_index_images()
 
 
 # ---------- File serving ----------
 
+MEDIA_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
+
+def _is_not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+    """Whether the client's cached copy (If-None-Match / If-Modified-Since) is current."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # If-None-Match takes precedence; If-Modified-Since is then ignored
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole-second resolution
+        return since.timestamp() >= int(stat.st_mtime)
+    return False
+
+
 @app.get("/files/{folder}/{filename}")
-def get_file(folder: str, filename: str):
+def get_file(folder: str, filename: str, request: Request):
     if folder not in ("images", "renderings"):
         raise HTTPException(status_code=404, detail="Folder not found")
     path = os.path.join(BASE_DIR, folder, filename)
-    if not os.path.exists(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(path)
+    # Filenames are UUIDs and never rewritten, so clients may cache forever
+    response = FileResponse(
+        path,
+        stat_result=stat,
+        media_type=MEDIA_TYPES.get(os.path.splitext(filename)[1].lower()),
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+    # Revalidation from a client that already has it – skip the body
+    if _is_not_modified(request, response.headers["etag"], stat):
+        return Response(status_code=304, headers={
+            k: response.headers[k] for k in ("etag", "last-modified", "cache-control")
+        })
+    return response
 
 
 # ---------- Image upload ----------
@@ -163,95 +352,241 @@ def get_file(folder: str, filename: str):
 async def upload_image(
     file: UploadFile = File(...),
     api_key: str = Depends(get_api_key),
-):
+) -> ImageUpload:
     # Generate unique filename
     ext = os.path.splitext(file.filename)[1].lower() or ".jpg"
     image_id = str(uuid.uuid4())
     filename = f"{image_id}{ext}"
     filepath = os.path.join(IMAGES_DIR, filename)
 
-    with open(filepath, "wb") as f:
-        f.write(await file.read())
+    # Stream to disk in 1 MiB chunks instead of holding the whole upload in RAM
+    async with aiofiles.open(filepath, "wb") as f:
+        while chunk := await file.read(1 << 20):
+            await f.write(chunk)
+    IMAGE_EXT[image_id] = ext
 
     file_url = f"/files/images/{filename}"
 
-    return {
-        "id": image_id,
-        "file_url": file_url,
-    }
+    return ImageUpload(
+        id=image_id,
+        file_url=file_url,
+    )
 
 
 # ---------- Rendering ----------
 
-def hex_to_rgb(hex_str: str):
-    hex_str = hex_str.lstrip("#")
-    if len(hex_str) == 3:
-        hex_str = "".join(c * 2 for c in hex_str)
-    return tuple(int(hex_str[i:i+2], 16) for i in (0, 2, 4))
+# alpha controls how strong the tint is (0.0 – 1.0)
+TINT_ALPHA = 0.35
 
 
-def simple_tint(input_path: str, output_path: str, hex_color: str):
-    """Very simple tint for demo: blends original with a solid color."""
-    base = Image.open(input_path).convert("RGB")
-    overlay_color = hex_to_rgb(hex_color)
-    overlay = Image.new("RGB", base.size, overlay_color)
-    # alpha controls how strong the tint is (0.0 – 1.0)
-    tinted = Image.blend(base, overlay, alpha=0.35)
-    tinted.save(output_path)
+@lru_cache(maxsize=256)
+def _tint_luts(rgb: tuple, alpha: float = TINT_ALPHA) -> np.ndarray:
+    """
+    Blend with a constant color is a per-channel mapping of 256 values:
+    lut[c][v] = round(v * (1 - alpha) + rgb[c] * alpha). 768 bytes, fits in L1.
+    The palette is small, so each color's tables are built once and reused.
+    """
+    levels = np.arange(256, dtype=np.float64)
+    luts = np.stack([
+        np.rint(levels * (1.0 - alpha) + t * alpha) for t in rgb
+    ]).astype(np.uint8)
+    # Shared between requests
+    luts.flags.writeable = False
+    return luts
+
+
+@njit(nogil=True, cache=True)
+def _tint(arr, lut, out):
+    """
+    One pass over the pixels, one table lookup per channel.
+    `out` is H×W×4 (RGBX) – Pillow's own 32-bit pixel layout – so the
+    result can be wrapped as an image without another copy.
+    """
+    for i in range(arr.shape[0]):
+        for j in range(arr.shape[1]):
+            out[i, j, 0] = lut[0, arr[i, j, 0]]
+            out[i, j, 1] = lut[1, arr[i, j, 1]]
+            out[i, j, 2] = lut[2, arr[i, j, 2]]
+            out[i, j, 3] = 255
+
+
+@njit(nogil=True, cache=True)
+def _tint_masked(arr, lut, mask, out):
+    """Like _tint, but pixels outside `mask` (H×W bool) are copied unchanged."""
+    for i in range(arr.shape[0]):
+        for j in range(arr.shape[1]):
+            if mask[i, j]:
+                out[i, j, 0] = lut[0, arr[i, j, 0]]
+                out[i, j, 1] = lut[1, arr[i, j, 1]]
+                out[i, j, 2] = lut[2, arr[i, j, 2]]
+            else:
+                out[i, j, 0] = arr[i, j, 0]
+                out[i, j, 1] = arr[i, j, 1]
+                out[i, j, 2] = arr[i, j, 2]
+            out[i, j, 3] = 255
+
+
+def _warm_up_tint():
+    """Compile (or load from cache) the kernel at import, not on the first request."""
+    arr = np.zeros((1, 1, 3), dtype=np.uint8)
+    arr.flags.writeable = False  # same array type as the cached base images
+    lut = _tint_luts(SW_DEFAULT_RGB, TINT_ALPHA)
+    out = np.empty((1, 1, 4), dtype=np.uint8)
+    _tint(arr, lut, out)
+    _tint_masked(arr, lut, np.ones((1, 1), dtype=np.bool_), out)
+    # Tables for the whole palette, so requests never build one
+    # (same call shape as simple_tint, so lru_cache keys match)
+    for rgb in set(SW_ANY.values()):
+        _tint_luts(rgb, TINT_ALPHA)
+
+
+_warm_up_tint()
+
+
+SAVE_OPTIONS = {
+    # No Huffman optimisation pass, baseline scan, 4:2:0 chroma subsampling
+    ".jpg": dict(format="JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False, subsampling=2),
+    ".png": dict(format="PNG", compress_level=PNG_COMPRESS_LEVEL),
+}
+
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def _load_rgb_array(path: str, mtime: float) -> np.ndarray:
+    """Decode an uploaded image once; mtime is part of the key so a replaced file is re-read."""
+    img = Image.open(path)
+    # Let the JPEG decoder downscale by a power of two while decoding
+    img.draft("RGB", (MAX_EDGE, MAX_EDGE))
+    img = img.convert("RGB")
+    if max(img.size) > MAX_EDGE:
+        img.thumbnail((MAX_EDGE, MAX_EDGE), Image.Resampling.LANCZOS)
+    arr = np.asarray(img)
+    # Shared between requests – make sure nobody tints it in place
+    arr.flags.writeable = False
+    return arr
+
+
+def _save(img: Image.Image, output_path: str):
+    ext = os.path.splitext(output_path)[1]
+    if ext == ".png" and img.mode == "RGBX":
+        # PNG has no RGBX mode; JPEG takes it as-is
+        img = img.convert("RGB")
+    img.save(output_path, **SAVE_OPTIONS[ext])
+
+
+def simple_tint(
+    base: np.ndarray,
+    output_path: str,
+    rgb: tuple,
+    mask: Optional[np.ndarray] = None,
+    alpha: float = TINT_ALPHA,
+):
+    """
+    Very simple tint for demo: blends original with a solid color.
+    If `mask` (H×W bool) is given, only those pixels are tinted.
+    """
+    h, w = base.shape[:2]
+    # The kernel does no bounds checking, and bases are scaled to MAX_EDGE,
+    # so a mask made at upload resolution must be rejected here.
+    if mask is not None and mask.shape != (h, w):
+        raise ValueError(f"mask shape {mask.shape} does not match image shape {(h, w)}")
+
+    # Trivial blends: nothing to tint, or the color replaces the image outright
+    if alpha <= 0.0 or (mask is not None and not mask.any()):
+        _save(Image.fromarray(base), output_path)
+        return
+    if alpha >= 1.0 and mask is None:
+        _save(Image.new("RGB", (w, h), rgb), output_path)
+        return
+
+    tinted = np.empty((h, w, 4), dtype=np.uint8)
+    if mask is None:
+        _tint(base, _tint_luts(rgb, alpha), tinted)
+    else:
+        _tint_masked(base, _tint_luts(rgb, alpha), np.ascontiguousarray(mask, dtype=np.bool_), tinted)
+    # Shares the buffer (no fill, no copy into Pillow's storage)
+    _save(Image.frombuffer("RGBX", (w, h), tinted, "raw", "RGBX", 0, 1), output_path)
+
+
+# Pillow and the tint kernel release the GIL, so threads scale across cores
+# while still sharing the decoded-image cache above (a process pool would
+# have to pickle every image across).
+RENDER_POOL = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+
+def render_image(input_path: str, output_path: str, rgb: tuple):
+    base = _load_rgb_array(input_path, os.path.getmtime(input_path))
+    simple_tint(base, output_path, rgb)
 
 
 @app.post("/renderings")
-def create_rendering(
+async def create_rendering(
     req: RenderingRequest,
+    response: Response,
     api_key: str = Depends(get_api_key),
-):
+) -> RenderingJob:
     # Check image exists
-    # For simplicity we assume .jpg, but you can search for any ext
-    possible_files = [f for f in os.listdir(IMAGES_DIR) if f.startswith(req.image_id)]
-    if not possible_files:
+    input_path = find_image_path(req.image_id)
+    if input_path is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    input_filename = possible_files[0]
-    input_path = os.path.join(IMAGES_DIR, input_filename)
 
     if not req.regions:
         raise HTTPException(status_code=400, detail="At least one region is required")
 
     # Use the first region's color_id for demo
-       color_key = req.regions[0].color_id
-    hex_color = resolve_sw_color(color_key)
+    color_key = req.regions[0].color_id
+    rgb = resolve_sw_rgb(color_key)
 
 
     job_id = str(uuid.uuid4())
-    ext = ".jpg" if req.output_format.lower() == "jpg" else ".png"
+    ext = "." + req.output_format
     output_filename = f"{job_id}{ext}"
     output_path = os.path.join(RENDER_DIR, output_filename)
 
-    # Synchronous "render"
-    simple_tint(input_path, output_path, hex_color)
-
     output_url = f"/files/renderings/{output_filename}"
 
+    if redis_client is not None:
+        # Hand off to worker.py and let the client poll GET /renderings/{id}
+        job = RenderingJob(id=job_id, status="queued", config=req)
+        await enqueue_job(job, {
+            "id": job_id,
+            "input_path": input_path,
+            "output_path": output_path,
+            "output_url": output_url,
+            "rgb": rgb,
+        })
+        response.status_code = 202
+        return job
+
+    # Render off the event loop so other requests keep being served
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(RENDER_POOL, render_image, input_path, output_path, rgb)
+
     job = RenderingJob(
         id=job_id,
         status="completed",
         output_url=output_url,
         config=req
     )
-    JOBS[job_id] = job
+    remember_job(job)
 
     # For demo we return the completed job immediately
     return job
 
 
 @app.get("/renderings/{job_id}")
-def get_rendering(job_id: str, api_key: str = Depends(get_api_key)):
-    job = JOBS.get(job_id)
+async def get_rendering(job_id: str, api_key: str = Depends(get_api_key)) -> RenderingJob:
+    if redis_client is not None:
+        job = await load_job(job_id)
+    else:
+        job = JOBS.get(job_id)
+        if job:
+            JOBS.move_to_end(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     return job
 
 @app.get("/colors")
-def list_colors(q: str | None = None):
+def list_colors(q: str | None = None) -> List[SWColor]:
     """
     Simple Sherwin-Williams color search:
     - GET /colors          → returns full color table
@@ -270,7 +605,7 @@ def list_colors(q: str | None = None):
     return items
 
 @app.get("/colors")
-def list_colors(q: str | None = None):
+def list_colors(q: str | None = None) -> List[SWColor]:
     """
     Simple Sherwin-Williams color search:
     - GET /colors          → returns full color table
@@ -287,3 +622,9 @@ def list_colors(q: str | None = None):
             or ql in c["id"].lower()
         ]
     return items
+
+
+if __name__ == "__main__":
+    # Dev server; see gunicorn.conf.py for production
+    import uvicorn
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
@@ -0,0 +1,78 @@
+"""
+Render worker for the Redis-backed queue.
+
+POST /renderings only enqueues when REDIS_URL is set; run this next to the
+API (same data/ directory) to actually produce the images:
+
+    REDIS_URL=redis://localhost:6379/0 python worker.py
+"""
+import asyncio
+import json
+import logging
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+import main
+
+log = logging.getLogger("worker")
+
+# Backoff (seconds) while Redis is unreachable
+RETRY_MIN = 0.5
+RETRY_MAX = 30.0
+
+
+async def _retry(op, *args):
+    """Run a Redis call, retrying with exponential backoff on connection errors."""
+    delay = RETRY_MIN
+    while True:
+        try:
+            return await op(*args)
+        except (ConnectionError, TimeoutError) as exc:
+            log.warning("Redis unavailable (%s), retrying in %.1fs", exc, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX)
+
+
+async def process(payload: str):
+    try:
+        task = json.loads(payload)
+        job_id = task["id"]
+        args = (task["input_path"], task["output_path"], tuple(task["rgb"]))
+        output_url = task["output_url"]
+    except (ValueError, KeyError, TypeError):
+        log.error("Skipping malformed task: %r", payload)
+        return
+
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(main.RENDER_POOL, main.render_image, *args)
+    except Exception:
+        log.exception("Render %s failed", job_id)
+        fields = {"status": "failed"}
+    else:
+        fields = {"status": "completed", "output_url": output_url}
+
+    if not await _retry(main.update_job, job_id, fields):
+        log.warning("Job %s expired before it finished; result not recorded", job_id)
+
+
+async def consume():
+    while True:
+        _, payload = await _retry(main.redis_client.brpop, main.RENDER_QUEUE)
+        try:
+            await process(payload)
+        except Exception:
+            # Never let one task take the consumer (and with it the worker) down
+            log.exception("Unexpected error handling task %r", payload)
+
+
+async def run():
+    if main.redis_client is None:
+        raise SystemExit("REDIS_URL is not set – nothing to consume")
+    # One consumer per render thread keeps the pool busy
+    await asyncio.gather(*(consume() for _ in range(main.RENDER_WORKERS)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    asyncio.run(run())